@@ -0,0 +1,277 @@
+"""
+python benchmarks/bench.py --save benchmarks/baseline.json
+python benchmarks/bench.py --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import gc
+import json
+import argparse
+import tempfile
+import tracemalloc
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Union
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
+
+from dori_orm import DB, columns, connection  # noqa: E402
+from dori_orm.aggregates import Avg, Count, Max, Min, Sum  # noqa: E402
+from dori_orm.operators import AND, NOT, OR, OPERATORS  # noqa: E402
+
+
+class Result(NamedTuple):
+    name: str
+    calls: int
+    ops_per_sec: float
+    p50: float
+    p95: float
+    p99: float
+    peak_memory: int
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    index = round(percent / 100 * (len(values) - 1))
+    return values[index]
+
+
+def measure(name: str, function: Callable, calls: int, batch: int = 1,
+            rows: int = 1, setup: Union[Callable, None] = None) -> Result:
+    # every call is timed on its own, the percentiles are the latency of
+    # one operation, setup runs untimed before each batch of calls
+    times = []
+    while len(times) < calls:
+        if setup is not None:
+            setup()
+        gc.collect()
+        for index in range(batch):
+            start = perf_counter()
+            function(index)
+            times.append(perf_counter() - start)
+    # memory is traced in a separate run, tracing slows the timed runs
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    for index in range(batch):
+        function(index)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return Result(
+        name=name,
+        calls=len(times),
+        ops_per_sec=rows * len(times) / sum(times),
+        p50=percentile(times, 50),
+        p95=percentile(times, 95),
+        p99=percentile(times, 99),
+        peak_memory=peak_memory,
+    )
+
+
+def make_models(directory: str) -> Dict[str, type]:
+    path = os.path.join(directory, 'bench.db')
+
+    class Person(DB):
+        db_name = path
+        name = columns.Text()
+        age = columns.Integer(index=True)
+        salary = columns.Real()
+
+    class Big(DB):
+        db_name = path
+        name = columns.Text()
+        age = columns.Integer()
+        salary = columns.Real()
+
+    return {'Person': Person, 'Big': Big}
+
+
+def people(count: int, start: int = 0) -> List[dict]:
+    return [
+        {
+            'name': f'name{i}',
+            'age': i % 100,
+            'salary': float(i % 1000) * 100,
+        }
+        for i in range(start, start + count)
+    ]
+
+
+def run(sizes: List[int], repeat: int, samples: int) -> List[Result]:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        models = make_models(directory)
+        Person, Big = models['Person'], models['Big']
+
+        def clear():
+            Person.all().delete()
+
+        inserted = people(1000)
+        results.append(measure(
+            'insert', lambda index: Person(**inserted[index]),
+            repeat * 1000, batch=1000, setup=clear,
+        ))
+        created = people(10_000)
+        results.append(measure(
+            'bulk_create', lambda _: Person.bulk_create(created),
+            samples, rows=10_000, setup=clear,
+        ))
+
+        clear()
+        Person.bulk_create(people(10_000))
+        lookups = {
+            'eq': {'age': 50},
+            'lt': {'age__lt': 10},
+            'lte': {'age__lte': 10},
+            'gt': {'age__gt': 90},
+            'gte': {'age__gte': 90},
+            'n': {'age__n': 50},
+            'in': {'age__in': [1, 2, 3]},
+            'like': {'name__like': 'name1%'},
+            'between': {'age__between': (10, 20)},
+        }
+        assert set(OPERATORS) <= set(lookups)
+        for operator, lookup in lookups.items():
+            results.append(measure(
+                f'filter[{operator}]',
+                lambda _, lookup=lookup: list(Person.filter(**lookup)),
+                samples,
+            ))
+        compositions = {
+            'AND': AND(age__gt=10, salary__lt=5000),
+            'OR': OR(age=1, name='name2'),
+            'NOT': NOT(OR(age__lt=90, salary__gt=100)),
+            'nested': OR(AND(age__gt=95, salary__lt=50_000), NOT(age__gt=1)),
+        }
+        for name, operator in compositions.items():
+            results.append(measure(
+                f'filter[{name}]',
+                lambda _, operator=operator: list(Person.filter(operator)),
+                samples,
+            ))
+
+        values = (1, 'name', 30, 100.0)
+        results.append(measure(
+            'row_construction', lambda _: Person._make_row(values),
+            repeat * 100_000, batch=100_000,
+        ))
+
+        rows = []
+
+        def fetch_rows():
+            rows[:] = Person.all().limit(1000)
+
+        def update_row(index: int):
+            row = rows[index]
+            row.update(age=row.age + 1)
+
+        results.append(measure(
+            'row_update', update_row, repeat * 1000, batch=1000,
+            setup=fetch_rows,
+        ))
+        results.append(measure(
+            'queryset_update', lambda _: Person.filter(age__lt=50).update(
+                salary=1.0,
+            ), samples,
+        ))
+        results.append(measure(
+            'aggregate', lambda _: Person.filter(age__gt=10).aggregate(
+                total=Sum('salary'), n=Count(), top=Max('age'),
+                low=Min('age'), mean=Avg('salary'),
+            ), samples,
+        ))
+        results.append(measure(
+            'group_by', lambda _: list(Person.group_by('age').annotate(
+                n=Count(), mean=Avg('salary'),
+            )), samples,
+        ))
+
+        def refill():
+            clear()
+            Person.bulk_create(people(1000))
+            fetch_rows()
+
+        results.append(measure(
+            'row_remove', lambda index: rows[index].remove(),
+            repeat * 1000, batch=1000, setup=refill,
+        ))
+
+        count = 0
+        for size in sorted(sizes):
+            Big.bulk_create(people(size - count, count))
+            count = size
+            # big tables get fewer samples, calls in the report says how many
+            results.append(measure(
+                f'all[{size}]', lambda _: list(Big.all()),
+                max(repeat, samples * 10_000 // size), rows=size,
+            ))
+        connection.close_all()
+    return results
+
+
+def compare(results: List[Result], baseline: Dict[str, dict],
+            tolerance: float) -> List[str]:
+    regressions = []
+    for result in results:
+        old = baseline.get(result.name)
+        if old is None:
+            continue
+        change = result.ops_per_sec / old['ops_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append(f'{result.name}: {change:+.1%} ops/s')
+    return regressions
+
+
+def report(results: List[Result]):
+    print(
+        f'{"benchmark":<20}{"calls":>8}{"ops/s":>14}{"p50 us":>10}'
+        f'{"p95 us":>10}{"p99 us":>10}{"peak KB":>10}'
+    )
+    for result in results:
+        print(
+            f'{result.name:<20}{result.calls:>8,}{result.ops_per_sec:>14,.0f}'
+            f'{result.p50 * 1e6:>10.1f}{result.p95 * 1e6:>10.1f}'
+            f'{result.p99 * 1e6:>10.1f}{result.peak_memory // 1024:>10,}'
+        )
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(description='dori-orm benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='batches of the per row benchmarks')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='timed calls of the query benchmarks')
+    parser.add_argument('--quick', action='store_true',
+                        help='small tables and few repeats')
+    parser.add_argument('--save', help='write results to a JSON baseline')
+    parser.add_argument('--compare', help='compare with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed ops/s drop before a regression')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.sizes, args.repeat, args.samples = [10_000], 2, 50
+
+    results = run(args.sizes, args.repeat, args.samples)
+    report(results)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(
+                {result.name: result._asdict() for result in results},
+                file, indent=2,
+            )
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
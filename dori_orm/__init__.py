@@ -1,3 +1,9 @@
 from .db import DB, ResultConfig
 from . import columns
 from . import operators
+from . import aggregates
+from . import connection
+from . import cache
+from . import aio
+from . import log
+from . import profiler
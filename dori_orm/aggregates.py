@@ -0,0 +1,37 @@
+from typing import Union
+
+
+class Aggregate:
+    def __init__(self, field: str, distinct: bool = False):
+        self.field = field
+        self.distinct = distinct
+        self.function = self.__class__.__name__.upper()
+
+    def generate_statement(self) -> str:
+        distinct = 'DISTINCT ' if self.distinct else ''
+        return f'{self.function}({distinct}{self.field})'
+
+    def __repr__(self) -> str:
+        return self.generate_statement()
+
+
+class Count(Aggregate):
+    def __init__(self, field: Union[str, None] = None,
+                 distinct: bool = False):
+        super().__init__(field or '*', distinct)
+
+
+class Sum(Aggregate):
+    pass
+
+
+class Avg(Aggregate):
+    pass
+
+
+class Max(Aggregate):
+    pass
+
+
+class Min(Aggregate):
+    pass
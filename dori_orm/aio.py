@@ -0,0 +1,84 @@
+from __future__ import annotations
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial
+from typing import AsyncIterator, Callable, Dict, Tuple, Union
+from dori_orm.connection import get_manager
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+# (db_name, executor) of the async transaction the current task is in
+_pinned: ContextVar[Union[Tuple[str, ThreadPoolExecutor], None]] = (
+    ContextVar('dori_orm_pinned', default=None)
+)
+
+
+def get_executor(db_name: str) -> ThreadPoolExecutor:
+    executor = _executors.get(db_name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(db_name)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    thread_name_prefix=f'dori_orm-{db_name}'
+                )
+                _executors[db_name] = executor
+    return executor
+
+
+def configure(db_name: str, max_workers: int) -> ThreadPoolExecutor:
+    with _executors_lock:
+        old = _executors.pop(db_name, None)
+        executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix=f'dori_orm-{db_name}'
+        )
+        _executors[db_name] = executor
+    if old is not None:
+        old.shutdown(wait=False)
+    return executor
+
+
+async def run(db_name: str, function: Callable, *args, **kwargs):
+    pinned = _pinned.get()
+    if pinned is not None and pinned[0] == db_name:
+        executor = pinned[1]
+    else:
+        executor = get_executor(db_name)
+    # the worker sees the caller's context, e.g. an open cache.session()
+    call = partial(copy_context().run, function, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+
+@asynccontextmanager
+async def atomic(db_name: str,
+                 immediate: bool = True) -> AsyncIterator[None]:
+    pinned = _pinned.get()
+    if pinned is not None and pinned[0] == db_name:
+        executor = pinned[1]
+        token = None
+    else:
+        # a transaction lives on one connection, so every query in it
+        # runs on the same thread
+        executor = ThreadPoolExecutor(
+            1, thread_name_prefix=f'dori_orm-{db_name}-atomic'
+        )
+        token = _pinned.set((db_name, executor))
+    transaction = get_manager(db_name).atomic(immediate)
+    try:
+        await run(db_name, transaction.__enter__)
+        try:
+            yield
+        except BaseException as error:
+            await run(
+                db_name, transaction.__exit__,
+                type(error), error, error.__traceback__,
+            )
+            raise
+        await run(db_name, transaction.__exit__, None, None, None)
+    finally:
+        if token is not None:
+            _pinned.reset(token)
+            executor.shutdown(wait=False)
@@ -0,0 +1,191 @@
+from __future__ import annotations
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Hashable, Iterator, Set, Tuple, Union
+
+MISSING = object()
+
+
+class IdentityMap:
+    def __init__(self, maxsize: int = 10_000) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # ((db_name, table_name), pk) -> row
+        self._rows: OrderedDict[
+            Tuple[Tuple[str, str], Hashable], object
+        ] = OrderedDict()
+
+    def get(self, table: Tuple[str, str], pk: Hashable):
+        row = self._rows.get((table, pk))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rows.move_to_end((table, pk))
+        return row
+
+    def add(self, table: Tuple[str, str], pk: Hashable, row):
+        # the first loaded instance wins, later loads return it
+        key = (table, pk)
+        existing = self._rows.get(key)
+        if existing is not None:
+            self._rows.move_to_end(key)
+            return existing
+        self._rows[key] = row
+        if len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+        return row
+
+    def discard(self, table: Tuple[str, str], pk: Hashable, keep=None):
+        key = (table, pk)
+        if self._rows.get(key) is not keep:
+            self._rows.pop(key, None)
+
+    def clear(self, table: Union[Tuple[str, str], None] = None):
+        if table is None:
+            self._rows.clear()
+            return
+        for key in [key for key in self._rows if key[0] == table]:
+            del self._rows[key]
+
+    def wrap(self, table: Tuple[str, str], convert: Callable) -> Callable:
+        def identity(values: tuple):
+            row = convert(values)
+            pk = getattr(row, 'id', None)
+            if pk is None:
+                return row
+            return self.add(table, pk, row)
+        return identity
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+_session: ContextVar[Union[IdentityMap, None]] = ContextVar(
+    'dori_orm_session', default=None
+)
+
+
+def current_session() -> Union[IdentityMap, None]:
+    return _session.get()
+
+
+@contextmanager
+def session(maxsize: int = 10_000) -> Iterator[IdentityMap]:
+    token = _session.set(IdentityMap(maxsize))
+    try:
+        yield _session.get()
+    finally:
+        _session.reset(token)
+
+
+class QueryCache:
+    def __init__(self, maxsize: int = 1024,
+                 ttl: Union[float, None] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple] = OrderedDict()
+        # (db_name, table_name) -> keys of the entries that read the table
+        self._tables: Dict[Tuple[str, str], Set[Hashable]] = {}
+        # (db_name, table_name) -> number of writes to the table
+        self._generations: Dict[Tuple[str, str], int] = {}
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires, _, value = entry
+            if expires is not None and expires < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, tables: Tuple[Tuple[str, str], ...]) -> tuple:
+        with self._lock:
+            return tuple(self._generations.get(table, 0) for table in tables)
+
+    def set(self, key: Hashable, tables: Tuple[Tuple[str, str], ...],
+            value, generation: Union[tuple, None] = None):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            # a write finished while the value was read, it may be stale
+            if generation is not None and generation != tuple(
+                self._generations.get(table, 0) for table in tables
+            ):
+                return
+            self._pop(key)
+            self._entries[key] = (expires, tables, value)
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, db_name: str, table_name: str):
+        with self._lock:
+            table = (db_name, table_name)
+            self._generations[table] = self._generations.get(table, 0) + 1
+            keys = self._tables.pop(table, ())
+            for key in list(keys):
+                self._pop(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+
+    def _pop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for table in entry[1]:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self._entries),
+        }
+
+
+_query_cache: Union[QueryCache, None] = None
+
+
+def enable_query_cache(maxsize: int = 1024,
+                       ttl: Union[float, None] = None) -> QueryCache:
+    global _query_cache
+    _query_cache = QueryCache(maxsize, ttl)
+    return _query_cache
+
+
+def disable_query_cache():
+    global _query_cache
+    _query_cache = None
+
+
+def get_query_cache() -> Union[QueryCache, None]:
+    return _query_cache
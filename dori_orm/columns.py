@@ -1,13 +1,17 @@
+import re
+import hashlib
 from typing import Union
 
 
 class Column:
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
         self.type = None
         self.unique = unique
         self.nullable = nullable
         self.default = default
+        self.index = index
 
     def __repr__(self):
         constraints = ''
@@ -23,113 +27,129 @@ class Column:
 
 class Int(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'INT'
 
 
 class Integer(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'INTEGER'
 
 
 class TinyInt(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'TINYINT'
 
 
 class SmallInt(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'SMALLINT'
 
 
 class MediumInt(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'MEDIUMINT'
 
 
 class Text(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'TEXT'
 
 
 class VarChar(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'VARCHAR(255)'
 
 
 class Blob(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'BLOB'
 
 
 class Real(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'REAL'
 
 
 class Double(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DOUBLE'
 
 
 class Float(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'FLOAT'
 
 
 class Numeric(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'NUMERIC'
 
 
 class Decimal(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DECIMAL(10,5)'
 
 
 class Boolean(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'BOOLEAN'
 
 
 class Date(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DATE'
 
 
 class DateTime(Column):
     def __init__(self, unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = False) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'DATETIME'
 
 
@@ -138,13 +158,94 @@ class ForeignKey(Column):
         self.column_name_ = name
 
     def __init__(self, reference: Union[object, str], unique: bool = False,
-                 nullable: bool = True, default: str = None) -> None:
-        super().__init__(unique, nullable, default)
+                 nullable: bool = True, default: str = None,
+                 index: bool = True) -> None:
+        super().__init__(unique, nullable, default, index)
         self.type = 'INTEGER'
-        if isinstance(reference, object):
+        # a model given by class is used as is, a name is looked up
+        # among the models of the same database
+        self.model = None
+        if not isinstance(reference, str):
+            self.model = reference
             reference = reference.__name__
         self.reference = reference.lower()
+        # (db name, table name) -> model and the model that holds the key,
+        # both set by DB when the model class is created
+        self.models = {}
+        self.owner = None
+
+    @property
+    def id_name(self) -> str:
+        return f'{self.column_name_.lower()}_id'
+
+    @property
+    def related_model(self):
+        if self.model is not None:
+            return self.model
+        return self.models[(self.owner.db_name, self.reference)]
 
     def get_foreign_key(self):
         name = self.column_name_
         return f'FOREIGN KEY ({name}) REFERENCES {self.reference} (id)'
+
+    def get_cached(self, instance):
+        related = getattr(instance, '_related', None)
+        if related is None:
+            return None
+        return related.get(self.column_name_.lower())
+
+    def set_cached(self, instance, value):
+        related = getattr(instance, '_related', None)
+        if related is None:
+            related = instance._related = {}
+        related[self.column_name_.lower()] = value
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        related_id = getattr(instance, self.id_name, None)
+        if related_id is None:
+            return None
+        related = self.get_cached(instance)
+        if related is None or related.id != related_id:
+            related = self.related_model.get_by_id(related_id)
+            self.set_cached(instance, related)
+        return related
+
+    def __set__(self, instance, value):
+        setattr(instance, self.id_name, getattr(value, 'id', value))
+        self.set_cached(instance, value if hasattr(value, 'id') else None)
+
+
+class Index:
+    def __init__(self, *columns: str, unique: bool = False,
+                 where: str = None, name: str = None) -> None:
+        self.columns = columns
+        self.unique = unique
+        self.where = where
+        self.name = name
+
+    def get_name(self, table_name: str) -> str:
+        # managed indexes are recognized by the ix_ prefix
+        name = self.name
+        if name is None:
+            # indexes on the same columns differ by unique and where
+            parts = [table_name, *self.columns]
+            if self.unique:
+                parts.append('unique')
+            if self.where:
+                parts.append(hashlib.sha1(self.where.encode()).hexdigest()[:8])
+            name = '_'.join(parts)
+        name = re.sub(r'\W+', '_', name.lower()).strip('_')
+        if not name.startswith('ix_'):
+            name = f'ix_{name}'
+        return name
+
+    def get_index(self, table_name: str) -> str:
+        unique = 'UNIQUE ' if self.unique else ''
+        columns = ', '.join(self.columns)
+        index = (f'CREATE {unique}INDEX {self.get_name(table_name)} '
+                 f'ON {table_name} ({columns})')
+        if self.where:
+            index += f' WHERE {self.where}'
+        return index
@@ -0,0 +1,333 @@
+from __future__ import annotations
+import os
+import queue
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+
+DEFAULT_PRAGMAS = {
+    # readers never block the writer and each other, across processes too
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -8000,
+}
+
+
+class Writer:
+    def __init__(self, manager: ConnectionManager,
+                 batch_size: int = 100) -> None:
+        self.manager = manager
+        self.batch_size = batch_size
+        self.writes = 0
+        self.batches = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f'dori_orm-{manager.db_name}-writer',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def execute(self, function: Callable[[sqlite3.Connection], object]):
+        if threading.current_thread() is self._thread:
+            return function(self.manager.connection())
+        future = Future()
+        self._queue.put((function, future))
+        return future.result()
+
+    def stop(self):
+        self._queue.put(None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            job = self._queue.get()
+            if job is None:
+                break
+            jobs = [job]
+            while len(jobs) < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            self._write(jobs)
+        self.manager.close()
+
+    def _write(self, jobs: List[Tuple[Callable, Future]]):
+        # one transaction per batch, a savepoint keeps a failing write
+        # from undoing the others
+        results = []
+        conn = self.manager.connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for function, future in jobs:
+                conn.execute('SAVEPOINT write')
+                try:
+                    results.append((future, function(conn), None))
+                except Exception as error:
+                    conn.execute('ROLLBACK TO SAVEPOINT write')
+                    results.append((future, None, error))
+                conn.execute('RELEASE SAVEPOINT write')
+            conn.execute('COMMIT')
+        except sqlite3.Error as error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for _, future in jobs:
+                future.set_exception(error)
+            return
+        self.writes += len(jobs)
+        self.batches += 1
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+class ConnectionManager:
+    def __init__(self, db_name: str,
+                 pragmas: Union[Dict[str, object], None] = None) -> None:
+        self.db_name = db_name
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.single_writer = False
+        self._reset()
+
+    def _reset(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: Dict[int, sqlite3.Connection] = {}
+        self._writer: Union[Writer, None] = None
+        self._generation = 0
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # connections and the writer thread inherited from the parent
+            # process belong to it, never use or close them in the child
+            self._reset()
+
+    def connection(self) -> sqlite3.Connection:
+        self._check_pid()
+        conn = getattr(self._local, 'connection', None)
+        if conn is None or self._local.generation != self._generation:
+            conn = self._connect()
+            self._local.connection = conn
+            self._local.generation = self._generation
+        else:
+            self.reused += 1
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit mode, transactions are opened explicitly by atomic()
+        conn = sqlite3.connect(
+            self.db_name,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        with self._lock:
+            self._prune()
+            old = self._connections.pop(threading.get_ident(), None)
+            if old is not None:
+                self._close(old)
+            self._connections[threading.get_ident()] = conn
+            self.opened += 1
+        return conn
+
+    def _prune(self):
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in list(self._connections):
+            if ident not in alive:
+                self._close(self._connections.pop(ident))
+
+    def _close(self, conn: sqlite3.Connection):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self.closed += 1
+
+    def writer(self) -> Union[Writer, None]:
+        if not self.single_writer:
+            return None
+        self._check_pid()
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = Writer(self)
+        return self._writer
+
+    def in_transaction(self) -> bool:
+        return getattr(self._local, 'depth', 0) > 0
+
+    def after_transaction(self, callback: Callable[[], None]):
+        # runs once the outermost transaction commits or rolls back
+        if not self.in_transaction():
+            callback()
+            return
+        callbacks = self._local.callbacks
+        if callback not in callbacks:
+            callbacks.append(callback)
+
+    def on_rollback(self, callback: Callable[[], None]):
+        # runs if the transaction or savepoint open now is rolled back
+        if not self.in_transaction():
+            return
+        self._local.rollbacks.append((self._local.depth, callback))
+
+    def _run_callbacks(self):
+        callbacks, self._local.callbacks = self._local.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def _run_rollbacks(self, depth: int):
+        # a rollback at this depth undoes everything done deeper
+        rollbacks = self._local.rollbacks
+        self._local.rollbacks = [
+            (level, callback)
+            for level, callback in rollbacks
+            if level <= depth
+        ]
+        for level, callback in rollbacks:
+            if level > depth:
+                callback()
+
+    @contextmanager
+    def atomic(self, immediate: bool = True) -> Iterator[sqlite3.Connection]:
+        conn = self.connection()
+        depth = getattr(self._local, 'depth', 0)
+        savepoint = f'sp_{depth}'
+        if depth == 0:
+            # a deferred transaction that reads and then writes can't wait
+            # for the write lock, busy_timeout doesn't cover the upgrade
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            self._local.callbacks = []
+            self._local.rollbacks = []
+        else:
+            conn.execute(f'SAVEPOINT {savepoint}')
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if conn.in_transaction:
+                if depth == 0:
+                    conn.execute('ROLLBACK')
+                else:
+                    conn.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
+                    conn.execute(f'RELEASE SAVEPOINT {savepoint}')
+            self._run_rollbacks(depth)
+            if depth == 0:
+                self._run_callbacks()
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            try:
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                self._run_rollbacks(depth)
+                raise
+            finally:
+                self._local.rollbacks = []
+                self._run_callbacks()
+        else:
+            conn.execute(f'RELEASE SAVEPOINT {savepoint}')
+
+    def close(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            return
+        self._local.connection = None
+        with self._lock:
+            self._connections.pop(threading.get_ident(), None)
+            self._close(conn)
+
+    def close_all(self):
+        if self._pid != os.getpid():
+            self._reset()
+            return
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            # pending writes are committed before the thread exits
+            writer.stop()
+        with self._lock:
+            for conn in self._connections.values():
+                self._close(conn)
+            self._connections.clear()
+            self._generation += 1
+
+    def stats(self) -> Dict[str, object]:
+        stats = {
+            'db_name': self.db_name,
+            'open': len(self._connections),
+            'opened': self.opened,
+            'reused': self.reused,
+            'closed': self.closed,
+        }
+        if self._writer is not None:
+            stats['writes'] = self._writer.writes
+            stats['batches'] = self._writer.batches
+        return stats
+
+
+_managers: Dict[str, ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(db_name: str) -> ConnectionManager:
+    manager = _managers.get(db_name)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(db_name)
+            if manager is None:
+                manager = ConnectionManager(db_name)
+                _managers[db_name] = manager
+    return manager
+
+
+def configure(db_name: str, single_writer: Union[bool, None] = None,
+              **pragmas) -> ConnectionManager:
+    manager = get_manager(db_name)
+    manager.pragmas.update(pragmas)
+    manager.close_all()
+    if single_writer is not None:
+        manager.single_writer = single_writer
+    return manager
+
+
+def atomic(db_name: str, immediate: bool = True):
+    return get_manager(db_name).atomic(immediate)
+
+
+def pool_stats() -> Dict[str, Dict[str, object]]:
+    return {
+        db_name: manager.stats()
+        for db_name, manager in _managers.items()
+    }
+
+
+def close_all():
+    for manager in list(_managers.values()):
+        manager.close_all()
+
+
+atexit.register(close_all)
@@ -1,135 +1,244 @@
 from __future__ import annotations
 import os
 import sqlite3
+import hashlib
 import inspect
-from typing import Dict, List, NamedTuple, Tuple, Union
-from dori_orm.operators import OPERATORS
-from dori_orm.columns import ForeignKey
+import threading
+from time import perf_counter
+from itertools import groupby
+from types import MappingProxyType
+from typing import (
+    Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Tuple,
+    Union,
+)
+from dori_orm import aio, log
+from dori_orm.aggregates import Aggregate, Avg, Count, Max, Min, Sum
+from dori_orm.cache import MISSING, current_session, get_query_cache
+from dori_orm.columns import Column, ForeignKey, Index
+from dori_orm.connection import get_manager
+from dori_orm.log import QueryRecord, get_query_log
+from dori_orm.query import QuerySet, ResultConfig
 
 
-class GenerateTableName:
-    def __get__(self, instance, owner) -> str:
-        return owner.__name__.lower()
+_schema_lock = threading.RLock()
+# public names of Row, a column can't have them
+ROW_ATTRIBUTES = ('data', 'update', 'remove')
 
 
-class GenerateDBName:
-    def __get__(self, instance, owner) -> str:
-        file_address = inspect.getfile(owner)
-        db_name = os.path.basename(file_address)[:-3]
-        return f"{db_name}.db"
+def _rowcount(cursor: sqlite3.Cursor) -> int:
+    return cursor.rowcount
 
 
-class GetColumns:
-    def get_columns(self, owner) -> Tuple[str, str]:
-        class_variables: Dict[str, str] = owner.__dict__
-        return (
-            (key, value)
-            for key, value in class_variables.items()
-            # remove python magic method from class variables
-            if not key.startswith('_')
-        )
+def _no_count(_) -> None:
+    return None
+
+
+def _inserted(ids: List[Union[int, None]]) -> int:
+    return sum(pk is not None for pk in ids)
+
+
+def _insert_each(conn: sqlite3.Connection, query: str,
+                 params: List[tuple]) -> List[Union[int, None]]:
+    ids = []
+    for values in params:
+        cursor = conn.execute(query, values)
+        # like insert(), ignored rows have no id
+        ids.append(cursor.lastrowid if cursor.rowcount == 1 else None)
+    return ids
+
 
-    def __get__(self, instance, owner) -> Dict[str, str]:
+class Schema(NamedTuple):
+    table_name: str
+    db_name: str
+    columns: Mapping[str, str]
+    column_names: Tuple[str, ...]
+    foreign_keys: Mapping[str, str]
+    relations: Mapping[str, ForeignKey]
+    indexes: Mapping[str, str]
+
+    @classmethod
+    def from_model(cls, model) -> Schema:
+        file_address = inspect.getfile(model)
+        db_name = os.path.basename(file_address)[:-3]
+        # only Column instances are columns, not methods or other settings
+        model_columns = [
+            (key.lower(), value)
+            for key, value in model.__dict__.items()
+            if not key.startswith('_') and isinstance(value, Column)
+        ]
+        for name, _ in model_columns:
+            if name in ROW_ATTRIBUTES:
+                raise ValueError(
+                    f'Column {name!r} of {model.__name__} would shadow '
+                    f'Row.{name}.'
+                )
         columns = {
-            name.lower(): f"{name.lower()} {value}"
-            for name, value in self.get_columns(owner)
-        }
-        return {
             'id': 'id INTEGER PRIMARY KEY UNIQUE NOT NULL',
-            **columns,
+            **{name: f"{name} {value}" for name, value in model_columns},
         }
-
-
-class GetForeignKeys:
-    def get_foreign_key_columns(self, owner) -> Tuple[str, str]:
-        class_variables: Dict[str, str] = owner.__dict__
-        return (
-            (key, value.get_foreign_key())
-            for key, value in class_variables.items()
+        relations = {
+            name: value
+            for name, value in model_columns
             if isinstance(value, ForeignKey)
+        }
+        foreign_keys = {
+            name: value.get_foreign_key()
+            for name, value in relations.items()
+        }
+        table_name = model.__name__.lower()
+        model_indexes = [
+            Index(name)
+            for name, value in model_columns
+            if value.index
+        ]
+        model_indexes.extend(model.__dict__.get('indexes', ()))
+        indexes = {}
+        for index in model_indexes:
+            name = index.get_name(table_name)
+            definition = index.get_index(table_name)
+            if indexes.get(name, definition) != definition:
+                raise ValueError(
+                    f'Two indexes of {model.__name__} are named {name!r}.'
+                )
+            indexes[name] = definition
+        return cls(
+            table_name=table_name,
+            db_name=f"{db_name}.db",
+            columns=MappingProxyType(columns),
+            column_names=tuple(columns),
+            foreign_keys=MappingProxyType(foreign_keys),
+            relations=MappingProxyType(relations),
+            indexes=MappingProxyType(indexes),
         )
 
-    def __get__(self, instance, owner) -> Dict[str, str]:
-        return {
-            key: value
-            for key, value in self.get_foreign_key_columns(owner)
-        }
 
+def get_schema(model) -> Schema:
+    schema = model.__dict__.get('_schema')
+    if schema is None:
+        return Schema.from_model(model)
+    return schema
 
-class Row:
-    def __init__(self, db_name_: str, table_name_: str, **data):
-        self.data = data
-        for key, value in data.items():
-            self.__setattr__(key, value)
-        Row.db_name = db_name_
-        Row.table_name = table_name_
 
-    def remove(self):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        query = f'DELETE FROM {self.table_name} WHERE {where}'
-        self._execute(query)
+class GenerateTableName:
+    def __get__(self, instance, owner) -> str:
+        return get_schema(owner).table_name
 
-    def update(self, **kwargs):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        new_data = ', '.join([
-            f'{key} = {repr(value)}'
-            for key, value in kwargs.items()
-        ])
-        if new_data.strip():
-            query = (
-                f'UPDATE {self.table_name} SET {new_data} WHERE {where}'
-            )
-            self._execute(query)
 
-    @ classmethod
-    def _execute(cls, query: str):
-        conn = sqlite3.connect(cls.db_name)
-        conn.execute(query)
-        conn.commit()
-        conn.close()
+class GenerateDBName:
+    def __get__(self, instance, owner) -> str:
+        return get_schema(owner).db_name
 
-    def __repr__(self) -> str:
-        result = ', '.join([
-            f'{repr(attr)}:{repr(value)}'
-            for attr, value in self.data.items()
-        ])
-        return f"<{result}>"
+
+class GetColumns:
+    def __get__(self, instance, owner) -> Mapping[str, str]:
+        return get_schema(owner).columns
 
 
-class Rows:
-    def __init__(self, rows: List[Row]):
-        self.rows = rows
+class GetForeignKeys:
+    def __get__(self, instance, owner) -> Mapping[str, str]:
+        return get_schema(owner).foreign_keys
 
-    def count(self) -> int:
-        return len(self.rows)
 
-    def first(self) -> Union[Row, None]:
-        if self.rows:
-            return self.rows[0]
-        return None
+class Row:
+    __slots__ = ()
+    # columns share this namespace, so the internals are underscored
+    _model = None
+    # column name -> slot name, foreign keys keep their id in <name>_id
+    _slots = {}
 
-    def last(self) -> Union[Row, None]:
-        if self.rows:
-            return self.rows[-1]
-        return None
+    @classmethod
+    def for_model(cls, model) -> type:
+        schema = model._schema
+        fields = schema.column_names
+        slots = {
+            name: (
+                schema.relations[name].id_name
+                if name in schema.relations else name
+            )
+            for name in fields
+        }
+        # generated like namedtuple, positional values go straight to slots
+        namespace = {}
+        exec(
+            f'def __init__(_self, {", ".join(fields)}):\n'
+            + ''.join(
+                f'    _self.{slot} = {name}\n'
+                for name, slot in slots.items()
+            ),
+            namespace,
+        )
+        return type(f'{model.__name__}Row', (cls,), {
+            '__slots__': (*slots.values(), '_related'),
+            '__init__': namespace['__init__'],
+            '_model': model,
+            '_slots': MappingProxyType(slots),
+            **schema.relations,
+        })
 
-    def __repr__(self) -> str:
-        return repr(self.rows)
+    @classmethod
+    def _partial(cls, fields: Iterable[str], values: Iterable) -> Row:
+        row = cls.__new__(cls)
+        slots = cls._slots
+        for name, value in zip(fields, values):
+            setattr(row, slots[name], value)
+        return row
+
+    @property
+    def data(self) -> Dict[str, object]:
+        data = {}
+        for name, slot in self._slots.items():
+            try:
+                data[name] = object.__getattribute__(self, slot)
+            except AttributeError:
+                pass
+        return data
+
+    def __getattr__(self, name: str):
+        # only called for unset slots, i.e. columns deferred by the query
+        model = self._model
+        if model is None or name == '_related':
+            raise AttributeError(name)
+        if name not in self._slots.values():
+            raise AttributeError(name)
+        data = self.data
+        if 'id' not in data:
+            raise AttributeError(f'{name} was not loaded and row has no id')
+        missing = [
+            field
+            for field in self._slots
+            if field not in data
+        ]
+        query = model._statement(('deferred', tuple(missing)), lambda: (
+            f'SELECT {", ".join(missing)} FROM {model.table_name} '
+            f'WHERE id = ?;'
+        ))
+        values = model._fetch_result(query, (data['id'],))
+        if values is None:
+            raise AttributeError(f'{name} was not loaded and row was removed')
+        for field, value in zip(missing, values):
+            setattr(self, self._slots[field], value)
+        return object.__getattribute__(self, name)
 
-    def __iter__(self) -> List[Row]:
-        return iter(self.rows)
+    def remove(self):
+        data = self.data
+        self._model._remove_row(data)
+        self._model._invalidate(data.get('id'))
 
+    def update(self, **kwargs):
+        if not kwargs:
+            return
+        data = self.data
+        self._model._update_row(data, kwargs)
+        self._model._invalidate(data.get('id'), keep=self)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
 
-class ResultConfig(NamedTuple):
-    limit: Union[int, None] = None
-    order_by: Union[str, None] = None
-    reverse: bool = False
+    def __repr__(self) -> str:
+        result = ', '.join([
+            f'{repr(attr)}:{repr(value)}'
+            for attr, value in self.data.items()
+        ])
+        return f"<{result}>"
 
 
 class DB:
@@ -137,174 +246,309 @@ class DB:
     table_name = GenerateTableName()
     columns = GetColumns()
     foreign_keys = GetForeignKeys()
-    _query = ''
+    _models: Dict[Tuple[str, str], type] = {}
+    # skip the table check while the stored hash matches the model
+    trust_schema_hash = False
+    _synced = True
+    _syncing = False
 
     def __init__(self, **data):
+        data = self._column_values(data)
         data = {
-            'id': self._get_max_id() + 1,
+            'id': self.insert(**data),
             **data,
         }
-        for key, value in data.items():
-            if key in self.foreign_keys.keys():
-                data[key] = value.id
         self.data = data
         for key, value in data.items():
             self.__setattr__(key, value)
         self.id = self.id  # just for type hinting
-        self.insert(**data)
 
     def __init_subclass__(cls, **kwargs):
-        cls._manage_table()
+        cls._refresh_schema()
+        # the table is checked on first use, or by sync_schema()
+        cls._synced = False
+        cls._syncing = False
+
+    @ classmethod
+    def _refresh_schema(cls):
+        cls._schema = Schema.from_model(cls)
+        cls._statements = {}
+        cls._row_class = Row.for_model(cls)
+        DB._models[(cls.db_name, cls._schema.table_name)] = cls
+        for relation in cls._schema.relations.values():
+            relation.models = DB._models
+            relation.owner = cls
 
     @classmethod
-    def insert(cls, **data: dict):
-        fields = ', '.join(data.keys())
-        values = ', '.join(
-            map(repr, data.values())
-        )
-        query = (f'INSERT OR IGNORE INTO {cls.table_name} '
-                 f'({fields}) VALUES ({values});')
-        cls._execute(query)
+    def insert(cls, **data: dict) -> Union[int, None]:
+        fields = tuple(data.keys())
+        query = cls._statement(('insert', fields), lambda: (
+            f'INSERT OR IGNORE INTO {cls.table_name} '
+            f'({", ".join(fields)}) VALUES ({", ".join("?" * len(fields))});'
+            if fields else
+            f'INSERT OR IGNORE INTO {cls.table_name} DEFAULT VALUES;'
+        ))
+        cursor = cls._execute(query, tuple(data.values()))
+        # ignored rows (e.g. unique conflicts) are not created
+        if cursor.rowcount == 1:
+            return cursor.lastrowid
+        return None
+
+    @ classmethod
+    def bulk_create(cls, rows: Iterable[Union[dict, DB, Row]],
+                    batch_size: int = 500, return_ids: bool = False
+                    ) -> Union[List[Union[int, None]], None]:
+        ids = [] if return_ids else None
+        batch = []
+        for row in rows:
+            batch.append(cls._bulk_data(row))
+            if len(batch) >= batch_size:
+                cls._bulk_insert(batch, ids)
+                batch = []
+        if batch:
+            cls._bulk_insert(batch, ids)
+        return ids
 
     @ classmethod
-    def all(cls, config: Union[ResultConfig, None] = None) -> List[Row]:
-        configs = cls._set_config(config)
-        query = f'SELECT * FROM {cls.table_name}{configs};'
-        return cls._fetchall(query)
+    def all(cls, config: Union[ResultConfig, None] = None) -> QuerySet:
+        return QuerySet(cls).configure(config)
 
     @ classmethod
     def get(cls, *fields: dict,
-            config: Union[ResultConfig, None] = None) -> List[Row]:
-        fields = [
+            config: Union[ResultConfig, None] = None) -> QuerySet:
+        fields = tuple(
             field
             for field in fields
-            if field in cls.columns
-        ]
-        fields_string = ', '.join(fields) or '*'
-        configs = cls._set_config(config)
-        query = f'SELECT {fields_string} FROM {cls.table_name}{configs};'
-        return cls._fetchall(query)
+            if field in cls._schema.columns
+        )
+        return QuerySet(cls, fields=fields).configure(config)
 
     @ classmethod
     def filter(cls, *args, config: Union[ResultConfig, None] = None,
-               **kwargs) -> List[Row]:
-        conditions = []
-        for key, value in kwargs.items():
-            if '__' in key:
-                condition = cls._set_operator_filter(key, value)
-            else:
-                condition = f'{key} = {repr(value)}'
-            if condition is not None:
-                conditions.append(condition)
-                condition = None
-        conditions.extend(list(map(repr, args)))
-        statements = ' AND '.join(conditions) or 'true'
-        configs = cls._set_config(config)
-        query = (
-            f'SELECT * FROM {cls.table_name} WHERE {statements}{configs};'
-        )
-        return cls._fetchall(query)
+               **kwargs) -> QuerySet:
+        return QuerySet(cls).filter(*args, **kwargs).configure(config)
+
+    @ classmethod
+    def get_by_id(cls, pk: int) -> Union[Row, None]:
+        session = current_session()
+        if session is not None:
+            row = session.get(cls._table(), pk)
+            if row is not None:
+                return row
+        return QuerySet(cls).filter(id=pk).first()
 
     @ classmethod
     def max(cls, column_name: str):
-        query = f'SELECT MAX({column_name}) FROM {cls.table_name};'
-        result = cls._fetch_result(query)
-        if result:
-            return {column_name: result[0]}
+        return cls.aggregate(**{column_name: Max(column_name)})
 
     @ classmethod
     def min(cls, column_name: str):
-        query = f'SELECT MIN({column_name}) FROM {cls.table_name};'
-        result = cls._fetch_result(query)
-        if result:
-            return {column_name: result[0]}
+        return cls.aggregate(**{column_name: Min(column_name)})
 
     @ classmethod
     def avg(cls, column_name: str):
-        query = f'SELECT AVG({column_name}) FROM {cls.table_name};'
-        result = cls._fetch_result(query)
-        if result:
-            return {column_name: result[0]}
+        return cls.aggregate(**{column_name: Avg(column_name)})
 
     @ classmethod
     def sum(cls, column_name: str):
-        query = f'SELECT SUM({column_name}) FROM {cls.table_name};'
-        result = cls._fetch_result(query)
-        if result:
-            return {column_name: result[0]}
+        return cls.aggregate(**{column_name: Sum(column_name)})
 
     @ classmethod
     def count(cls):
-        query = f'SELECT COUNT(1) FROM {cls.table_name};'
-        result = cls._fetch_result(query)
-        if result:
-            return {'count': result[0]}
+        return cls.aggregate(count=Count())
+
+    @ classmethod
+    def aggregate(cls, **aggregates: Aggregate) -> Dict[str, object]:
+        return QuerySet(cls).aggregate(**aggregates)
+
+    @ classmethod
+    def group_by(cls, *fields: str) -> QuerySet:
+        return QuerySet(cls).group_by(*fields)
 
     @classmethod
-    def first(cls) -> DB:
-        query = f'SELECT * FROM {cls.table_name} WHERE id=1;'
-        result = cls._fetch_result(query)
-        if result is None:
-            return None
-        row = dict(zip(cls.columns.keys(), result))
-        return Row(cls.db_name, cls.table_name, **row)
+    def first(cls) -> Union[Row, None]:
+        return QuerySet(cls).first()
 
     @classmethod
-    def last(cls) -> DB:
-        max_id = cls._get_max_id()
-        query = f'SELECT * FROM {cls.table_name} WHERE id={max_id};'
-        result = cls._fetch_result(query)
-        if result is None:
-            return None
-        row = dict(zip(cls.columns.keys(), result))
-        return Row(cls.db_name, cls.table_name, **row)
+    def last(cls) -> Union[Row, None]:
+        return QuerySet(cls).last()
 
     def remove(self):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        query = f'DELETE FROM {self.table_name} WHERE {where};'
-        self._execute(query)
+        self._remove_row(self.data)
+        self._invalidate(self.data.get('id'))
 
     def update(self, **kwargs):
-        where = ' AND '.join([
-            f'{key} = {repr(value)}'
-            for key, value in self.data.items()
-        ])
-        new_data = ', '.join([
-            f'{key} = {repr(value)}'
-            for key, value in kwargs.items()
-        ])
-        if new_data.strip():
-            query = (
-                f'UPDATE {self.table_name} SET {new_data} WHERE {where};'
-            )
-            self._execute(query)
-        query = f'SELECT * FROM {self.table_name} WHERE id={self.id};'
-        result = self._fetch_result(query)
-        data = dict(zip(self.columns.keys(), result))
-        self.data = data
-        self.__dict__.update(data)
+        if not kwargs:
+            return
+        self._update_row(self.data, kwargs)
+        self._invalidate(self.data.get('id'))
+        self.data = {**self.data, **self._column_values(kwargs)}
+        for key, value in kwargs.items():
+            self.__setattr__(key, value)
 
     @ classmethod
     def remove_table(cls):
         query = f'DROP TABLE {cls.table_name}'
         cls._execute(query)
+        cls._invalidate()
+        cls._set_schema_hash(None)
+        cls._synced = False
+
+    @ classmethod
+    def transaction(cls, immediate: bool = True):
+        return get_manager(cls.db_name).atomic(immediate)
+
+    @ classmethod
+    def atransaction(cls, immediate: bool = True):
+        return aio.atomic(cls.db_name, immediate)
+
+    @ classmethod
+    async def acreate(cls, **data) -> DB:
+        return await aio.run(cls.db_name, cls, **data)
+
+    @ classmethod
+    async def abulk_create(cls, rows: Iterable[Union[dict, DB, Row]],
+                           batch_size: int = 500,
+                           return_ids: bool = False
+                           ) -> Union[List[Union[int, None]], None]:
+        return await aio.run(
+            cls.db_name, cls.bulk_create, rows, batch_size, return_ids
+        )
+
+    @ classmethod
+    async def aall(cls, config: Union[ResultConfig, None] = None) -> List:
+        return await aio.run(cls.db_name, list, cls.all(config))
+
+    @ classmethod
+    async def afilter(cls, *args, config: Union[ResultConfig, None] = None,
+                      **kwargs) -> List:
+        queryset = cls.filter(*args, config=config, **kwargs)
+        return await aio.run(cls.db_name, list, queryset)
+
+    @ classmethod
+    async def aget_by_id(cls, pk: int) -> Union[Row, None]:
+        return await aio.run(cls.db_name, cls.get_by_id, pk)
+
+    @ classmethod
+    def pool_stats(cls):
+        return get_manager(cls.db_name).stats()
 
     @ classmethod
     def queries(cls):
-        return cls._query.strip()
+        query_log = get_query_log()
+        if query_log is None:
+            return ''
+        return '\n\n'.join(record.sql for record in query_log.records(cls))
 
     @ classmethod
-    def _manage_table(cls) -> str:
+    def sync_schema(cls, force: bool = False):
+        if cls is DB:
+            for model in list(DB._models.values()):
+                model.sync_schema(force)
+            return
+        with _schema_lock:
+            # queries of the sync itself must not start it again
+            if cls._syncing:
+                return
+            cls._syncing = True
+            try:
+                cls._manage_table(force)
+            finally:
+                cls._syncing = False
+            cls._synced = True
+            # a rollback of the caller's transaction undoes the sync too
+            get_manager(cls.db_name).on_rollback(cls._unsync)
+
+    @ classmethod
+    def _unsync(cls):
+        cls._synced = False
+
+    @ classmethod
+    def _ensure_schema(cls):
+        with _schema_lock:
+            # another thread may have synced while this one waited
+            if not cls._synced:
+                cls.sync_schema()
+
+    @ classmethod
+    def _manage_table(cls, force: bool = False):
+        schema_hash = None
+        if cls.trust_schema_hash:
+            schema_hash = cls._schema_hash()
+            if not force and cls._get_schema_hash() == schema_hash:
+                return
+        if cls._table_changed():
+            # one transaction for every change, and a second process
+            # doing the same sync waits and then finds nothing to do
+            with cls.transaction(immediate=True):
+                cls._update_table()
+        if schema_hash is not None:
+            cls._set_schema_hash(schema_hash)
+
+    @ classmethod
+    def _table_changed(cls) -> bool:
+        current_columns = cls._get_current_table_columns()
+        return (
+            set(current_columns) != set(cls._schema.column_names)
+            or cls._get_current_indexes() != dict(cls._schema.indexes)
+        )
+
+    @ classmethod
+    def _update_table(cls):
+        current_columns = cls._get_current_table_columns()
+        if not current_columns:
+            cls._create_table()
+            cls._create_indexes({})
+            return
+        current_indexes = cls._get_current_indexes()
+        # stale indexes go first, sqlite can't drop an indexed column
+        cls._drop_indexes(current_indexes)
+        if set(current_columns) != set(cls._schema.column_names):
+            cls._alter_columns(current_columns)
+            cls._drop_columns(current_columns)
+        cls._create_indexes(current_indexes)
+
+    @ classmethod
+    def _schema_hash(cls) -> str:
+        schema = cls._schema
+        definition = '\n'.join((
+            *schema.columns.values(),
+            *schema.foreign_keys.values(),
+            *sorted(schema.indexes.values()),
+        ))
+        return hashlib.sha1(definition.encode()).hexdigest()
+
+    @ classmethod
+    def _get_schema_hash(cls) -> Union[str, None]:
+        query = 'SELECT hash FROM dori_orm_schema WHERE table_name = ?;'
         try:
-            current_columns = cls._get_current_table_columns()
-            if current_columns != list(cls.columns.keys()):
-                cls._alter_columns(current_columns)
-                cls._drop_columns(current_columns)
+            cur = cls._cursor(query, (cls.table_name,))
         except sqlite3.OperationalError:
-            cls._create_table()
+            return None
+        result = cur.fetchone()
+        cur.close()
+        return result[0] if result else None
+
+    @ classmethod
+    def _set_schema_hash(cls, schema_hash: Union[str, None]):
+        if schema_hash is None:
+            if cls._get_schema_hash() is not None:
+                cls._execute(
+                    'DELETE FROM dori_orm_schema WHERE table_name = ?;',
+                    (cls.table_name,),
+                )
+            return
+        if cls._get_schema_hash() == schema_hash:
+            return
+        cls._execute(
+            'CREATE TABLE IF NOT EXISTS dori_orm_schema '
+            '(table_name TEXT PRIMARY KEY, hash TEXT NOT NULL);'
+        )
+        cls._execute(
+            'INSERT OR REPLACE INTO dori_orm_schema (table_name, hash) '
+            'VALUES (?, ?);',
+            (cls.table_name, schema_hash),
+        )
 
     @ classmethod
     def _create_table(cls) -> str:
@@ -333,102 +577,274 @@ class DB:
         removed_columns = [
             column
             for column in current_columns
-            if column not in cls.columns.keys()
+            if column not in cls._schema.columns
         ]
         for field in removed_columns:
             query = f'ALTER TABLE {cls.table_name} DROP {field};'
             cls._execute(query)
 
-    @ staticmethod
-    def _set_config(config: Union[ResultConfig, None]) -> str:
-        if config is None:
-            return ''
-        limit, order_by, reverse = config
-        if limit is None:
-            limit = ''
-        else:
-            limit = f' LIMIT {limit}'
-        if order_by is None:
-            order_by = ''
-            sorting = ''
+    @classmethod
+    def _get_current_indexes(cls) -> Dict[str, str]:
+        query = (
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND name LIKE 'ix\\_%' ESCAPE '\\';"
+        )
+        cur = cls._cursor(query, (cls.table_name,))
+        indexes = dict(cur.fetchall())
+        cur.close()
+        return indexes
+
+    @classmethod
+    def _drop_indexes(cls, current_indexes: Dict[str, str]):
+        for name, index in current_indexes.items():
+            if cls._schema.indexes.get(name) != index:
+                cls._execute(f'DROP INDEX IF EXISTS {name};')
+
+    @classmethod
+    def _create_indexes(cls, current_indexes: Dict[str, str]):
+        for name, index in cls._schema.indexes.items():
+            if current_indexes.get(name) != index:
+                query = index.replace('INDEX', 'INDEX IF NOT EXISTS', 1)
+                cls._execute(f'{query};')
+
+    @ classmethod
+    def _match(cls, data: dict) -> Tuple[str, tuple]:
+        # rows are matched by primary key, by every loaded value without it
+        if data.get('id') is not None:
+            return 'id = ?', (data['id'],)
+        keys = tuple(data)
+        where = cls._statement(('match', keys), lambda: ' AND '.join(
+            f'{key} IS ?'
+            for key in keys
+        ))
+        return where, tuple(data.values())
+
+    @ classmethod
+    def _table(cls) -> Tuple[str, str]:
+        # tables of the same name in two databases are different tables
+        return (cls.db_name, cls.table_name)
+
+    @ classmethod
+    def _invalidate(cls, pk: Union[int, None] = None, keep: Row = None):
+        session = current_session()
+        if session is None:
+            return
+        if pk is None:
+            session.clear(cls._table())
         else:
-            order_by = F'ORDER BY {order_by}'
-            if reverse is False:
-                sorting = ' ASC'
-            else:
-                sorting = ' DESC'
-        return f' {order_by}{sorting}{limit}'
-
-    @ staticmethod
-    def _set_operator_filter(key: str, value: str):
-        filter = key.split('__')
-        if len(filter) != 2:
-            return None
-        key, operator = filter
-        key, operator = key.lower(), operator.lower()
-        if operator in OPERATORS:
-            return (
-                f'{key} {OPERATORS[operator]} {repr(value)}'
-            )
-        elif operator == 'between':
-            start, *_, end = value
-            return (
-                f'{key} BETWEEN {repr(start)} AND {repr(end)}'
-            )
+            session.discard(cls._table(), pk, keep)
+
+    @ classmethod
+    def _column_values(cls, values: dict) -> dict:
+        relations = cls._schema.relations
+        return {
+            key: getattr(value, 'id', value) if key in relations else value
+            for key, value in values.items()
+        }
+
+    @ classmethod
+    def _update_row(cls, data: dict, values: dict):
+        values = cls._column_values(values)
+        where, params = cls._match(data)
+        fields = tuple(values)
+        query = cls._statement(('update', fields, where), lambda: (
+            f'UPDATE {cls.table_name} '
+            f'SET {", ".join(f"{key} = ?" for key in fields)} '
+            f'WHERE {where};'
+        ))
+        cls._execute(query, (*values.values(), *params))
+
+    @ classmethod
+    def _remove_row(cls, data: dict):
+        where, params = cls._match(data)
+        query = cls._statement(('remove', where), lambda: (
+            f'DELETE FROM {cls.table_name} WHERE {where};'
+        ))
+        cls._execute(query, params)
+
+    @ classmethod
+    def _statement(cls, key: tuple, build) -> str:
+        statement = cls._statements.get(key)
+        if statement is None:
+            if len(cls._statements) >= 512:
+                cls._statements.clear()
+            statement = cls._statements[key] = build()
+        return statement
+
+    @ classmethod
+    def _bulk_data(cls, row: Union[dict, DB, Row]) -> dict:
+        if isinstance(row, dict):
+            data = dict(row)
         else:
-            return None
+            # copy of an existing row, sqlite assigns the new id
+            data = dict(row.data)
+            data.pop('id', None)
+        return cls._column_values(data)
 
     @ classmethod
-    def _get_max_id(cls):
-        query = f'SELECT MAX(id) FROM {cls.table_name}'
-        result = cls._fetch_result(query)
-        return result[0] or 0
+    def _bulk_insert(cls, batch: List[dict],
+                     ids: Union[List[Union[int, None]], None] = None):
+        with cls.transaction(immediate=True):
+            for fields, group in groupby(batch, key=lambda d: tuple(d)):
+                # conflicts are ignored like in insert(), they don't abort
+                # the batch after earlier batches were committed
+                query = cls._statement(('bulk_insert', fields), lambda: (
+                    f'INSERT OR IGNORE INTO {cls.table_name} '
+                    f'({", ".join(fields)}) '
+                    f'VALUES ({", ".join("?" * len(fields))});'
+                    if fields else
+                    f'INSERT OR IGNORE INTO {cls.table_name} DEFAULT VALUES;'
+                ))
+                params = [tuple(data.values()) for data in group]
+                if ids is None:
+                    cls._executemany(query, params)
+                else:
+                    # ignored rows leave gaps, so each row gets its own id
+                    ids.extend(cls._write(
+                        query, params,
+                        lambda conn: _insert_each(conn, query, params),
+                        _inserted,
+                    ))
 
     @ classmethod
-    def _execute(cls, query: str):
-        cls._query += f"{query}\n\n"
-        conn = sqlite3.connect(cls.db_name)
-        conn.execute(query)
-        conn.commit()
-        conn.close()
+    def _connection(cls) -> sqlite3.Connection:
+        return get_manager(cls.db_name).connection()
 
     @ classmethod
-    def _fetchall(cls, query: str) -> Rows:
-        cls._query += f"{query}\n\n"
-        conn = sqlite3.connect(cls.db_name)
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
-        result = []
-        for row in rows:
-            row = dict(zip(
-                cls.columns.keys(),
-                row
-            ))
-            result.append(
-                Row(cls.db_name, cls.table_name, **row)
-            )
-        conn.close()
-        return Rows(result)
+    def _execute(cls, query: str, params: tuple = ()):
+        return cls._write(
+            query, params, lambda conn: conn.execute(query, params),
+        )
 
     @ classmethod
-    def _fetch_result(cls, query: str):
-        cls._query += f"{query}\n\n"
-        conn = sqlite3.connect(cls.db_name)
-        cur = conn.cursor()
-        cur.execute(query)
-        result = cur.fetchone()
-        conn.close()
+    def _executemany(cls, query: str, params: List[tuple]):
+        cls._write(
+            query, params, lambda conn: conn.executemany(query, params),
+        )
+
+    @ classmethod
+    def _write(cls, query: str, params: Union[tuple, List[tuple]],
+               function: Callable, count: Callable = _rowcount):
+        manager = get_manager(cls.db_name)
+        writer = manager.writer()
+        # explicit transactions keep their writes on their own connection
+        local = writer is None or manager.in_transaction()
+        try:
+            return cls._run(query, params, lambda: (
+                function(cls._connection()) if local
+                else writer.execute(function)
+            ), count)
+        finally:
+            # after the write, reads that ran during it are dropped too
+            cls._invalidate_results()
+
+    @ classmethod
+    def _run(cls, query: str, params: tuple, function: Callable,
+             count: Callable = len):
+        if not cls._synced:
+            cls._ensure_schema()
+        if not log.enabled:
+            return function()
+        log.emit_before(cls, query, params)
+        start = perf_counter()
+        result = function()
+        log.emit_after(QueryRecord(
+            cls, query, params, perf_counter() - start, count(result),
+        ))
         return result
 
+    @ classmethod
+    def _invalidate_results(cls):
+        query_cache = get_query_cache()
+        if query_cache is None:
+            return
+        query_cache.invalidate(cls.db_name, cls.table_name)
+        manager = get_manager(cls.db_name)
+        if manager.in_transaction():
+            # other threads may cache the old rows until the commit
+            manager.after_transaction(cls._invalidate_results)
+
+    @ classmethod
+    def _cached(cls, query: str, params: tuple, fetch: Callable,
+                tables: Tuple[str, ...] = ()):
+        query_cache = get_query_cache()
+        # reads inside a transaction may see uncommitted rows
+        if (query_cache is None
+                or get_manager(cls.db_name).in_transaction()):
+            return fetch()
+        key = (cls.db_name, query, params)
+        result = query_cache.get(key)
+        if result is MISSING:
+            tables = tuple(
+                (cls.db_name, table)
+                for table in (cls.table_name, *tables)
+            )
+            generation = query_cache.generation(tables)
+            result = fetch()
+            query_cache.set(key, tables, result, generation)
+        return result
+
+    @ classmethod
+    def _cursor(cls, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        cur = cls._connection().cursor()
+        cur.execute(query, params)
+        return cur
+
+    @ classmethod
+    def _fetchall(cls, query: str, params: tuple = (),
+                  convert: Union[Callable, None] = None,
+                  tables: Tuple[str, ...] = ()) -> List:
+        def fetch():
+            cur = cls._cursor(query, params)
+            rows = cur.fetchall()
+            cur.close()
+            return tuple(rows)
+
+        rows = cls._cached(
+            query, params, lambda: cls._run(query, params, fetch), tables,
+        )
+        return list(map(convert or cls._make_row, rows))
+
+    @ classmethod
+    def _iterate(cls, query: str, params: tuple = (),
+                 chunk_size: int = 1000,
+                 convert: Union[Callable, None] = None) -> Iterator:
+        convert = convert or cls._make_row
+        # streamed rows are not counted
+        cur = cls._run(
+            query, params, lambda: cls._cursor(query, params), _no_count,
+        )
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from map(convert, rows)
+        finally:
+            cur.close()
+
+    @ classmethod
+    def _make_row(cls, values: tuple) -> Row:
+        return cls._row_class(*values)
+
+    @ classmethod
+    def _fetch_result(cls, query: str, params: tuple = ()):
+        def fetch():
+            cur = cls._cursor(query, params)
+            result = cur.fetchone()
+            cur.close()
+            return result
+
+        return cls._cached(query, params, lambda: cls._run(
+            query, params, fetch, lambda result: int(result is not None),
+        ))
+
     @classmethod
-    def _get_current_table_columns(cls):
-        query = f'SELECT * FROM {cls.table_name}'
-        conn = sqlite3.connect(cls.db_name)
-        cur = conn.cursor()
-        cur.execute(query)
-        columns = [description[0] for description in cur.description]
-        conn.close()
+    def _get_current_table_columns(cls) -> List[str]:
+        # no rows when the table doesn't exist
+        cur = cls._cursor(f'PRAGMA table_info({cls.table_name});')
+        columns = [row[1] for row in cur.fetchall()]
+        cur.close()
         return columns
 
     def __repr__(self) -> str:
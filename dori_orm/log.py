@@ -0,0 +1,104 @@
+from __future__ import annotations
+import threading
+from collections import deque
+from typing import Callable, List, NamedTuple, Union
+
+
+class QueryRecord(NamedTuple):
+    model: type
+    sql: str
+    params: tuple
+    duration: float
+    rows: Union[int, None]
+
+
+class QueryLog:
+    def __init__(self, maxsize: int = 1000) -> None:
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._records: deque = deque(maxlen=maxsize)
+
+    def append(self, record: QueryRecord):
+        with self._lock:
+            self._records.append(record)
+
+    def records(self, model: Union[type, None] = None) -> List[QueryRecord]:
+        with self._lock:
+            records = list(self._records)
+        if model is None:
+            return records
+        return [
+            record
+            for record in records
+            if issubclass(record.model, model)
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
+_query_log: Union[QueryLog, None] = None
+_before_hooks: List[Callable[[type, str, tuple], None]] = []
+_after_hooks: List[Callable[[QueryRecord], None]] = []
+# checked before every query, nothing else runs while it is False
+enabled = False
+
+
+def _update():
+    global enabled
+    enabled = bool(
+        _query_log is not None or _before_hooks or _after_hooks
+    )
+
+
+def enable_query_log(maxsize: int = 1000) -> QueryLog:
+    global _query_log
+    _query_log = QueryLog(maxsize)
+    _update()
+    return _query_log
+
+
+def disable_query_log():
+    global _query_log
+    _query_log = None
+    _update()
+
+
+def get_query_log() -> Union[QueryLog, None]:
+    return _query_log
+
+
+def before_execute(hook: Callable[[type, str, tuple], None]) -> Callable:
+    _before_hooks.append(hook)
+    _update()
+    return hook
+
+
+def after_execute(hook: Callable[[QueryRecord], None]) -> Callable:
+    _after_hooks.append(hook)
+    _update()
+    return hook
+
+
+def remove_hook(hook: Callable):
+    for hooks in (_before_hooks, _after_hooks):
+        if hook in hooks:
+            hooks.remove(hook)
+    _update()
+
+
+def emit_before(model: type, sql: str, params: tuple):
+    for hook in tuple(_before_hooks):
+        hook(model, sql, params)
+
+
+def emit_after(record: QueryRecord):
+    query_log = _query_log
+    if query_log is not None:
+        query_log.append(record)
+    for hook in tuple(_after_hooks):
+        hook(record)
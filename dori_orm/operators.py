@@ -1,3 +1,6 @@
+from functools import lru_cache
+from typing import Iterator, Tuple, Union
+
 OPERATORS = {
     'lt': '<',
     'lte': '<=',
@@ -9,26 +12,85 @@ OPERATORS = {
 }
 
 
+@lru_cache(maxsize=1024)
+def lookup_statement(key: str, size: int = 1) -> Union[str, None]:
+    if '__' not in key:
+        return f'{key} = ?'
+    lookup = key.split('__')
+    if len(lookup) != 2:
+        return None
+    key, operator = lookup
+    key, operator = key.lower(), operator.lower()
+    if operator == 'in':
+        placeholders = ', '.join('?' * size)
+        return f'{key} IN ({placeholders})'
+    elif operator in OPERATORS:
+        return f'{key} {OPERATORS[operator]} ?'
+    elif operator == 'between':
+        return f'{key} BETWEEN ? AND ?'
+    else:
+        return None
+
+
+def compile_lookup(key: str, value) -> Tuple[str, tuple]:
+    operator = key.rsplit('__', 1)[-1].lower() if '__' in key else None
+    if operator == 'in':
+        params = tuple(value)
+    elif operator == 'between':
+        start, *_, end = value
+        params = (start, end)
+    else:
+        params = (value,)
+    # rows and model instances are compared by their id
+    params = tuple(getattr(param, 'id', param) for param in params)
+    statement = lookup_statement(key, len(params))
+    if statement is None:
+        # a dropped condition would widen the query, e.g. a bulk delete
+        raise ValueError(f'Unknown lookup {key!r}.')
+    return statement, params
+
+
+def compile_condition(condition) -> Tuple[str, tuple]:
+    if isinstance(condition, Operator):
+        return condition.generate_statements()
+    return str(condition), ()
+
+
+def compile_filter(args: tuple, kwargs: dict) -> Tuple[tuple, tuple]:
+    conditions = []
+    params = []
+    for key, value in kwargs.items():
+        condition, lookup_params = compile_lookup(key, value)
+        conditions.append(condition)
+        params.extend(lookup_params)
+    for arg in args:
+        condition, arg_params = compile_condition(arg)
+        conditions.append(condition)
+        params.extend(arg_params)
+    return tuple(conditions), tuple(params)
+
+
+def lookup_fields(args: tuple, kwargs: dict) -> Iterator[str]:
+    for key in kwargs:
+        yield key.split('__', 1)[0].lower()
+    for arg in args:
+        if isinstance(arg, Operator):
+            yield from lookup_fields(arg.args, arg.fields)
+
+
 class Operator:
     def __init__(self, *args, **kwargs):
         self.fields = kwargs
         self.args = args
         self.operator = self.__class__.__name__
 
-    def generate_statements(self):
+    def generate_statements(self) -> Tuple[str, tuple]:
         operator = f' {self.operator} '
-        statements = [
-            f'{key}={repr(value)}'
-            for key, value in self.fields.items()
-        ]
-        args_statements = operator.join(
-            map(str, self.args))
-        if args_statements:
-            statements.append(args_statements)
-        return f"({operator.join(statements)})"
+        statements, params = compile_filter(self.args, self.fields)
+        return f"({operator.join(statements)})", params
 
     def __repr__(self) -> str:
-        return self.generate_statements()
+        return self.generate_statements()[0]
 
 
 class AND(Operator):
@@ -44,5 +106,6 @@ class NOT(Operator):
         super().__init__(*args, **kwargs)
         self.operator = 'AND'
 
-    def __repr__(self) -> str:
-        return f"NOT {super().__repr__()}"
+    def generate_statements(self) -> Tuple[str, tuple]:
+        statement, params = super().generate_statements()
+        return f"NOT {statement}", params
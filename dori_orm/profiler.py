@@ -0,0 +1,134 @@
+from __future__ import annotations
+import sqlite3
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, NamedTuple, Tuple, Union
+from dori_orm import log
+from dori_orm.log import QueryRecord
+
+EXPLAINED = ('SELECT', 'UPDATE', 'DELETE')
+
+
+class SlowQuery(NamedTuple):
+    record: QueryRecord
+    plan: Tuple[str, ...]
+
+
+class Profiler:
+    def __init__(self, threshold: float = 0.1, explain: bool = True,
+                 repeated: int = 10) -> None:
+        self.threshold = threshold
+        self.explain = explain
+        self.repeated = repeated
+        self.slow_queries: List[SlowQuery] = []
+        self.scans: Dict[str, Tuple[str, ...]] = {}
+        self.counts: Counter = Counter()
+        self._plans: Dict[str, Tuple[str, ...]] = {}
+        self._lock = threading.Lock()
+        self._token = None
+
+    def __enter__(self) -> Profiler:
+        _start()
+        self._token = _profiler.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _profiler.reset(self._token)
+        self._token = None
+        _stop()
+
+    def n_plus_one(self) -> Dict[str, int]:
+        # the same statement run again and again, usually once per row
+        # of an earlier result
+        return {
+            sql: count
+            for sql, count in self.counts.items()
+            if count >= self.repeated and sql.startswith('SELECT')
+        }
+
+    def report(self) -> Dict[str, object]:
+        return {
+            'queries': sum(self.counts.values()),
+            'slow': [
+                (query.record.sql, query.record.duration, query.plan)
+                for query in self.slow_queries
+            ],
+            'scans': self.scans,
+            'n_plus_one': self.n_plus_one(),
+        }
+
+    def _record(self, record: QueryRecord):
+        # async queries of one context run on several worker threads
+        with self._lock:
+            self.counts[record.sql] += 1
+            first = self.counts[record.sql] == 1
+        plan = None
+        if self.explain and first:
+            plan = self._plan(record)
+            scans = tuple(
+                detail
+                for detail in plan
+                if detail.startswith('SCAN ')
+                and detail != 'SCAN CONSTANT ROW'
+            )
+            if scans:
+                self.scans[record.sql] = scans
+        if record.duration >= self.threshold:
+            if plan is None:
+                plan = self._plans.get(record.sql, ())
+            self.slow_queries.append(SlowQuery(record, plan))
+
+    def _plan(self, record: QueryRecord) -> Tuple[str, ...]:
+        plan = self._plans.get(record.sql)
+        if plan is not None:
+            return plan
+        plan = ()
+        # executemany params are a list of rows, there is no single plan
+        if (record.sql.startswith(EXPLAINED)
+                and isinstance(record.params, tuple)):
+            try:
+                plan = tuple(
+                    row[-1]
+                    for row in record.model._connection().execute(
+                        f'EXPLAIN QUERY PLAN {record.sql}', record.params,
+                    )
+                )
+            except sqlite3.Error:
+                pass
+        self._plans[record.sql] = plan
+        return plan
+
+
+_profiler: ContextVar[Union[Profiler, None]] = ContextVar(
+    'dori_orm_profiler', default=None
+)
+_lock = threading.Lock()
+_active = 0
+
+
+def _dispatch(record: QueryRecord):
+    profiler = _profiler.get()
+    if profiler is not None:
+        profiler._record(record)
+
+
+def _start():
+    global _active
+    with _lock:
+        if _active == 0:
+            log.after_execute(_dispatch)
+        _active += 1
+
+
+def _stop():
+    global _active
+    with _lock:
+        _active -= 1
+        if _active == 0:
+            log.remove_hook(_dispatch)
+
+
+def profile(threshold: float = 0.1, explain: bool = True,
+            repeated: int = 10) -> Profiler:
+    return Profiler(threshold, explain, repeated)
@@ -0,0 +1,610 @@
+from __future__ import annotations
+import json
+import base64
+import binascii
+from array import array
+from operator import itemgetter
+from typing import (
+    AsyncIterator, Callable, Dict, Iterator, List, NamedTuple, Tuple, Union
+)
+from dori_orm import aio
+from dori_orm.aggregates import Aggregate
+from dori_orm.cache import current_session
+from dori_orm.operators import compile_filter, lookup_fields
+
+
+class ResultConfig(NamedTuple):
+    limit: Union[int, None] = None
+    order_by: Union[str, None] = None
+    reverse: bool = False
+
+
+class Page(NamedTuple):
+    rows: List
+    after: Union[str, None] = None
+
+
+def encode_token(fields: tuple, values: tuple) -> str:
+    data = json.dumps([fields, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_token(token: str, fields: tuple) -> tuple:
+    try:
+        token_fields, values = json.loads(base64.urlsafe_b64decode(token))
+    except (binascii.Error, ValueError, TypeError):
+        raise ValueError('Invalid pagination token.') from None
+    if tuple(token_fields) != fields or len(values) != len(fields):
+        raise ValueError('Pagination token does not match order_by.')
+    return tuple(values)
+
+
+class QuerySet:
+    def __init__(self, model, fields: tuple = (), conditions: tuple = (),
+                 params: tuple = (), order_by: tuple = (),
+                 limit: Union[int, None] = None, mode: str = 'rows',
+                 related: tuple = (), prefetch: tuple = (),
+                 group_by: tuple = (), annotations: tuple = ()) -> None:
+        self.model = model
+        self._fields = fields
+        self._conditions = conditions
+        self._params = params
+        self._ordering = order_by
+        self._limit = limit
+        self._mode = mode
+        self._related = related
+        self._prefetch = prefetch
+        self._group_by = group_by
+        self._annotations = annotations
+        self._result_cache = None
+
+    def _clone(self, **changes) -> QuerySet:
+        options = {
+            'fields': self._fields,
+            'conditions': self._conditions,
+            'params': self._params,
+            'order_by': self._ordering,
+            'limit': self._limit,
+            'mode': self._mode,
+            'related': self._related,
+            'prefetch': self._prefetch,
+            'group_by': self._group_by,
+            'annotations': self._annotations,
+            **changes,
+        }
+        return self.__class__(self.model, **options)
+
+    def filter(self, *args, **kwargs) -> QuerySet:
+        self._check_fields(lookup_fields(args, kwargs))
+        conditions, params = compile_filter(args, kwargs)
+        return self._clone(
+            conditions=self._conditions + conditions,
+            params=self._params + params,
+        )
+
+    def order_by(self, *fields: str) -> QuerySet:
+        ordering = tuple(
+            f'{field[1:]} DESC' if field.startswith('-') else f'{field} ASC'
+            for field in fields
+        )
+        return self._clone(order_by=ordering)
+
+    def limit(self, limit: Union[int, None]) -> QuerySet:
+        return self._clone(limit=limit)
+
+    def paginate(self, after: Union[str, None] = None,
+                 order_by: tuple = ('id',), size: int = 100) -> Page:
+        if self._mode not in ('rows', 'values'):
+            raise TypeError('paginate() works on rows and values results.')
+        fields = tuple(order_by)
+        names = tuple(field.lstrip('-') for field in fields)
+        self._check_fields(names)
+        if 'id' not in names:
+            # id breaks ties, so every row has a unique position
+            fields += ('-id' if fields[-1].startswith('-') else 'id',)
+            names += ('id',)
+        if self._mode == 'values' and not set(names) <= set(self._fields):
+            raise ValueError('values() must include the order_by fields.')
+        queryset = self.order_by(*fields).limit(size + 1)
+        if after is not None:
+            condition, params = self._keyset(
+                fields, decode_token(after, fields),
+            )
+            queryset = queryset._clone(
+                conditions=queryset._conditions + (condition,),
+                params=queryset._params + params,
+            )
+        rows = queryset._fetch()
+        if len(rows) <= size:
+            return Page(rows)
+        rows = rows[:size]
+        return Page(rows, encode_token(fields, self._key(rows[-1], names)))
+
+    def _keyset(self, fields: tuple,
+                values: tuple) -> Tuple[str, tuple]:
+        descending = tuple(field.startswith('-') for field in fields)
+        names = tuple(field.lstrip('-') for field in fields)
+        columns = self.model._schema.columns
+        if len(set(descending)) == 1 and None not in values and (
+            not descending[0]
+            or all('NOT NULL' in columns[name] for name in names)
+        ):
+            # a row value comparison can seek on a composite index, it is
+            # only right while no NULL sorts after the key
+            return (
+                f'({", ".join(names)}) {"<" if descending[0] else ">"} '
+                f'({", ".join("?" * len(names))})'
+            ), values
+        # NULLs sort first, so they come before any value in ascending
+        # order and after every value in descending order
+        conditions = []
+        params = []
+        for index, (name, value) in enumerate(zip(names, values)):
+            if value is None and descending[index]:
+                continue
+            if value is None:
+                after, after_params = f'{name} IS NOT NULL', ()
+            elif descending[index]:
+                after, after_params = f'({name} < ? OR {name} IS NULL)', (
+                    value,
+                )
+            else:
+                after, after_params = f'{name} > ?', (value,)
+            conditions.append(' AND '.join((
+                *(f'{previous} IS ?' for previous in names[:index]),
+                after,
+            )))
+            params.extend((*values[:index], *after_params))
+        if not conditions:
+            return '0', ()
+        return f'({" OR ".join(conditions)})', tuple(params)
+
+    def _key(self, row, names: tuple) -> tuple:
+        if self._mode == 'values':
+            return tuple(row[name] for name in names)
+        slots = self.model._row_class.slots
+        return tuple(getattr(row, slots[name]) for name in names)
+
+    def select_related(self, *relations: str) -> QuerySet:
+        self._check_relations(relations)
+        return self._clone(related=self._related + relations)
+
+    def prefetch_related(self, *relations: str) -> QuerySet:
+        self._check_relations(relations)
+        return self._clone(prefetch=self._prefetch + relations)
+
+    def _check_relations(self, relations: tuple):
+        for name in relations:
+            if name not in self.model._schema.relations:
+                raise ValueError(
+                    f'{name!r} is not a foreign key of {self.model.__name__}'
+                )
+
+    def group_by(self, *fields: str) -> QuerySet:
+        self._check_fields(fields)
+        return self._clone(group_by=fields)
+
+    def annotate(self, **aggregates: Aggregate) -> QuerySet:
+        annotations = self._annotations + self._aggregates(aggregates)
+        return self._clone(annotations=annotations, mode='annotate')
+
+    def aggregate(self, **aggregates: Aggregate) -> Dict[str, object]:
+        if not aggregates:
+            return {}
+        expressions = self._aggregates(aggregates)
+        columns = ', '.join(expression for _, expression in expressions)
+        if self._limit is None:
+            query = self.model._statement(
+                ('aggregate', columns, self._conditions),
+                lambda: (
+                    f'SELECT {columns} FROM {self.model.table_name}'
+                    f'{self._where()};'
+                ),
+            )
+            params = self._params
+        else:
+            queryset = self._clone(group_by=(), annotations=(), mode='rows')
+            query, params = queryset._compile(columns='*')
+            query = f'SELECT {columns} FROM ({query[:-1]});'
+        result = self.model._fetch_result(query, params)
+        return dict(zip(aggregates, result))
+
+    def _aggregates(self, aggregates: Dict[str, Aggregate]) -> tuple:
+        self._check_fields(
+            aggregate.field
+            for aggregate in aggregates.values()
+            if aggregate.field != '*'
+        )
+        return tuple(
+            (name, aggregate.generate_statement())
+            for name, aggregate in aggregates.items()
+        )
+
+    def _check_fields(self, fields):
+        for field in fields:
+            if field not in self.model._schema.columns:
+                raise ValueError(
+                    f'{field!r} is not a column of {self.model.__name__}'
+                )
+
+    def only(self, *fields: str) -> QuerySet:
+        fields = ('id', *(
+            field
+            for field in self._known_fields(fields)
+            if field != 'id'
+        ))
+        return self._clone(fields=fields, mode='rows')
+
+    def defer(self, *fields: str) -> QuerySet:
+        self._check_fields(fields)
+        fields = tuple(
+            field
+            for field in self.model._schema.column_names
+            if field == 'id' or field not in fields
+        )
+        return self._clone(fields=fields, mode='rows')
+
+    def values(self, *fields: str) -> QuerySet:
+        return self._clone(fields=self._known_fields(fields), mode='values')
+
+    def values_list(self, *fields: str, flat: bool = False) -> QuerySet:
+        if flat and len(fields) != 1:
+            raise TypeError('flat=True needs exactly one field.')
+        return self._clone(
+            fields=self._known_fields(fields),
+            mode='flat' if flat else 'values_list',
+        )
+
+    def to_columns(self, *fields: str,
+                   numpy: bool = False) -> Dict[str, Union[array, List]]:
+        queryset = self.values_list(*fields)
+        names = queryset._fields
+        rows = list(queryset)
+        columns = zip(*rows) if rows else ([] for _ in names)
+        if numpy:
+            import numpy as np
+            return {
+                name: np.asarray(values)
+                for name, values in zip(names, columns)
+            }
+        return {
+            name: self._to_array(values)
+            for name, values in zip(names, columns)
+        }
+
+    @ staticmethod
+    def _to_array(values) -> Union[array, List]:
+        types = set(map(type, values))
+        try:
+            if types == {int}:
+                return array('q', values)
+            if types and types <= {int, float}:
+                return array('d', values)
+        except OverflowError:
+            pass
+        return list(values)
+
+    def _known_fields(self, fields: tuple) -> tuple:
+        self._check_fields(fields)
+        return fields or self.model._schema.column_names
+
+    def _converter(self) -> Union[Callable, None]:
+        if self._mode == 'rows':
+            if not self._fields:
+                return None
+            row_class = self.model._row_class
+            fields = self._fields
+            return lambda row: row_class._partial(fields, row)
+        if self._mode == 'values':
+            names = self._fields
+            return lambda row: dict(zip(names, row))
+        if self._mode == 'values_list':
+            return tuple
+        if self._mode == 'flat':
+            return itemgetter(0)
+        if self._mode == 'annotate':
+            names = (*self._group_by, *dict(self._annotations))
+            return lambda row: dict(zip(names, row))
+        return None
+
+    def configure(self, config: Union[ResultConfig, None]) -> QuerySet:
+        if config is None:
+            return self
+        limit, order_by, reverse = config
+        queryset = self
+        if order_by is not None:
+            if reverse:
+                order_by = f'-{order_by}'
+            queryset = queryset.order_by(order_by)
+        if limit is not None:
+            queryset = queryset.limit(limit)
+        return queryset
+
+    def _where(self) -> str:
+        if not self._conditions:
+            return ''
+        return f' WHERE {" AND ".join(self._conditions)}'
+
+    def _compile(self, columns: Union[str, None] = None,
+                 ordering: Union[tuple, None] = None,
+                 limit: Union[int, None] = None) -> Tuple[str, tuple]:
+        if columns is None and self._mode == 'annotate':
+            columns = ', '.join((*self._group_by, *(
+                f'{expression} AS {name}'
+                for name, expression in self._annotations
+            )))
+        elif columns is None:
+            columns = ', '.join(
+                self._fields or self.model._schema.column_names
+            )
+        if ordering is None:
+            ordering = self._ordering
+        if limit is None:
+            limit = self._limit
+        group_by = self._group_by
+        key = ('select', columns, self._conditions, group_by, ordering,
+               limit is None)
+        query = self.model._statement(key, lambda: (
+            f'SELECT {columns} FROM {self.model.table_name}{self._where()}'
+            + (f' GROUP BY {", ".join(group_by)}' if group_by else '')
+            + (f' ORDER BY {", ".join(ordering)}' if ordering else '')
+            + ('' if limit is None else ' LIMIT ?')
+            + ';'
+        ))
+        if limit is None:
+            return query, self._params
+        return query, (*self._params, limit)
+
+    def _select(self, ordering: Union[tuple, None] = None,
+                limit: Union[int, None] = None) -> Tuple[str, tuple, Callable]:
+        if self._mode != 'rows':
+            query, params = self._compile(ordering=ordering, limit=limit)
+            return query, params, self._converter()
+        session = current_session()
+        if not self._related:
+            query, params = self._compile(ordering=ordering, limit=limit)
+            convert = self._converter() or self.model._make_row
+            if session is not None:
+                convert = session.wrap(self.model._table(), convert)
+            return query, params, convert
+        if ordering is None:
+            ordering = self._ordering
+        model = self.model
+        fields = self._fields or model._schema.column_names
+        fields += tuple(
+            name
+            for name in self._related
+            if name not in fields
+        )
+        base, params = self._compile(
+            columns=', '.join(fields), ordering=ordering, limit=limit,
+        )
+        relations = [
+            (name, model._schema.relations[name].related_model)
+            for name in self._related
+        ]
+
+        def build():
+            # filter, order and limit run in the subquery, so conditions
+            # never see the columns of the joined tables
+            columns = [f'_t.{field}' for field in fields]
+            joins = ''
+            for name, related_model in relations:
+                columns.extend(
+                    f'_{name}.{field}'
+                    for field in related_model._schema.column_names
+                )
+                joins += (f' LEFT JOIN {related_model.table_name} AS _{name}'
+                          f' ON _{name}.id = _t.{name}')
+            query = f'SELECT {", ".join(columns)} FROM ({base[:-1]}) AS _t'
+            query += joins
+            if ordering:
+                query += ' ORDER BY ' + ', '.join(
+                    f'_t.{order}'
+                    for order in ordering
+                )
+            return f'{query};'
+
+        query = model._statement(('related', base, self._related), build)
+        row_class = model._row_class
+        size = len(fields)
+
+        def convert(values: tuple):
+            row = row_class._partial(fields, values)
+            start = size
+            for name, related_model in relations:
+                end = start + len(related_model._schema.column_names)
+                related = values[start:end]
+                start = end
+                if related[0] is None:
+                    related = None
+                elif session is None:
+                    related = related_model._make_row(related)
+                else:
+                    related = session.add(
+                        related_model._table(), related[0],
+                        related_model._make_row(related),
+                    )
+                model._schema.relations[name].set_cached(row, related)
+            return row
+
+        if session is not None:
+            convert = session.wrap(model._table(), convert)
+
+        return query, params, convert
+
+    def _fetch(self, ordering: Union[tuple, None] = None,
+               limit: Union[int, None] = None) -> List:
+        query, params, convert = self._select(ordering, limit)
+        tables = ()
+        if self._mode == 'rows':
+            tables = tuple(
+                self.model._schema.relations[name].related_model.table_name
+                for name in self._related
+            )
+        rows = self.model._fetchall(query, params, convert, tables)
+        if self._prefetch and self._mode == 'rows':
+            self._prefetch_rows(rows)
+        return rows
+
+    def _prefetch_rows(self, rows: List):
+        for name in self._prefetch:
+            relation = self.model._schema.relations[name]
+            ids = list({
+                getattr(row, relation.id_name)
+                for row in rows
+            } - {None})
+            related = {}
+            # keep the IN list under sqlite's bound parameter limit
+            for start in range(0, len(ids), 900):
+                for obj in relation.related_model.filter(
+                    id__in=ids[start:start + 900]
+                ):
+                    related[obj.id] = obj
+            for row in rows:
+                relation.set_cached(
+                    row, related.get(getattr(row, relation.id_name))
+                )
+
+    def _iterate_prefetched(self, rows: Iterator,
+                            chunk_size: int) -> Iterator:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                self._prefetch_rows(chunk)
+                yield from chunk
+                chunk = []
+        self._prefetch_rows(chunk)
+        yield from chunk
+
+    def _scalar(self, query: str, params: tuple):
+        result = self.model._fetch_result(query, params)
+        return result[0] if result else None
+
+    def _target(self) -> Tuple[str, tuple]:
+        if self._limit is None and not self._ordering:
+            return self._where(), self._params
+        # limited writes go through the ids of the selected rows
+        query, params = self._compile(columns='id')
+        return f' WHERE id IN ({query[:-1]})', params
+
+    def update(self, **values) -> int:
+        if not values:
+            return 0
+        self._check_fields(values)
+        where, params = self._target()
+        fields = tuple(values)
+        query = self.model._statement(('bulk_update', fields, where), lambda: (
+            f'UPDATE {self.model.table_name} '
+            f'SET {", ".join(f"{key} = ?" for key in fields)}{where};'
+        ))
+        self._result_cache = None
+        self.model._invalidate()
+        values = self.model._column_values(values)
+        cursor = self.model._execute(query, (*values.values(), *params))
+        return cursor.rowcount
+
+    def delete(self) -> int:
+        where, params = self._target()
+        query = self.model._statement(('bulk_delete', where), lambda: (
+            f'DELETE FROM {self.model.table_name}{where};'
+        ))
+        self._result_cache = None
+        self.model._invalidate()
+        cursor = self.model._execute(query, params)
+        return cursor.rowcount
+
+    def count(self) -> int:
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._limit is None and not self._group_by:
+            query = self.model._statement(
+                ('count', self._conditions),
+                lambda: (
+                    f'SELECT COUNT(*) FROM {self.model.table_name}'
+                    f'{self._where()};'
+                ),
+            )
+            return self._scalar(query, self._params)
+        query, params = self._compile(columns='1')
+        return self._scalar(
+            f'SELECT COUNT(*) FROM ({query[:-1]});', params
+        )
+
+    def exists(self) -> bool:
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        query, params = self._compile(columns='1', ordering=(), limit=1)
+        return bool(self._scalar(f'SELECT EXISTS ({query[:-1]});', params))
+
+    def first(self):
+        if self._result_cache is not None:
+            return self._result_cache[0] if self._result_cache else None
+        rows = self._fetch(ordering=self._ordering or ('id ASC',), limit=1)
+        return rows[0] if rows else None
+
+    def last(self):
+        if self._result_cache is not None or self._limit is not None:
+            rows = list(self)
+            return rows[-1] if rows else None
+        ordering = tuple(
+            f'{field} {"ASC" if direction == "DESC" else "DESC"}'
+            for field, direction in map(str.split, self._ordering)
+        ) or ('id DESC',)
+        rows = self._fetch(ordering=ordering, limit=1)
+        return rows[0] if rows else None
+
+    def iterator(self, chunk_size: int = 1000) -> Iterator:
+        if self._result_cache is not None:
+            return iter(self._result_cache)
+        query, params, convert = self._select()
+        rows = self.model._iterate(query, params, chunk_size, convert)
+        if self._prefetch and self._mode == 'rows':
+            return self._iterate_prefetched(rows, chunk_size)
+        return rows
+
+    def __iter__(self) -> Iterator:
+        if self._result_cache is None:
+            self._result_cache = self._fetch()
+        return iter(self._result_cache)
+
+    async def __aiter__(self) -> AsyncIterator:
+        if self._result_cache is None:
+            self._result_cache = await aio.run(
+                self.model.db_name, self._fetch
+            )
+        for row in self._result_cache:
+            yield row
+
+    async def acount(self) -> int:
+        return await aio.run(self.model.db_name, self.count)
+
+    async def aexists(self) -> bool:
+        return await aio.run(self.model.db_name, self.exists)
+
+    async def afirst(self):
+        return await aio.run(self.model.db_name, self.first)
+
+    async def alast(self):
+        return await aio.run(self.model.db_name, self.last)
+
+    async def aaggregate(self, **aggregates: Aggregate) -> Dict[str, object]:
+        return await aio.run(
+            self.model.db_name, self.aggregate, **aggregates
+        )
+
+    async def apaginate(self, after: Union[str, None] = None,
+                        order_by: tuple = ('id',), size: int = 100) -> Page:
+        return await aio.run(
+            self.model.db_name, self.paginate, after, order_by, size
+        )
+
+    async def aupdate(self, **values) -> int:
+        return await aio.run(self.model.db_name, self.update, **values)
+
+    async def adelete(self) -> int:
+        return await aio.run(self.model.db_name, self.delete)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
@@ -2,6 +2,9 @@
 from dori_orm import DB, ResultConfig
 from dori_orm.operators import AND, OR, NOT
 from dori_orm import columns
+from dori_orm import log
+
+log.enable_query_log()
 
 
 class Person(DB):